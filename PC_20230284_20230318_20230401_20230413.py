@@ -1,4 +1,5 @@
 import json
+from concurrent.futures import ProcessPoolExecutor
 import numpy as np
 from PIL import Image
 import os
@@ -30,18 +31,23 @@ def loco_predict(img, i, j, c):
     else:
         return A + B - C
 
+# loco_predict for arrays of neighbours: A = left, B = top, C = top-left
+def med_predict(A, B, C):
+    lo = np.minimum(A, B)
+    hi = np.maximum(A, B)
+    return np.where(C >= hi, lo, np.where(C <= lo, hi, A + B - C))
+
+# loco_predict for every pixel of the image at once (open loop: neighbours come from img itself)
+def loco_predict_image(img):
+    predicted = img.copy() # first row and column predict themselves
+    predicted[1:, 1:] = med_predict(img[1:, :-1], img[:-1, 1:], img[:-1, :-1])
+    return predicted
+
 def analysis_pass(image_path):
     img = np.array(Image.open(image_path).convert('RGB'), dtype=np.int32)
-    h, w, _ = img.shape
-    global_min = [999999]*3
-    global_max = [-999999]*3
-    for i in range(h):
-        for j in range(w):
-            for c in range(3):
-                pred = loco_predict(img, i, j, c)
-                err = img[i, j, c] - pred
-                if err < global_min[c]: global_min[c] = err
-                if err > global_max[c]: global_max[c] = err
+    error = img - loco_predict_image(img)
+    global_min = [int(x) for x in error.min(axis=(0, 1))]
+    global_max = [int(x) for x in error.max(axis=(0, 1))]
     return global_min, global_max
 
 def generate_codebook_uniform_rgb(basename,bits=2, codebook_json="codebook_rgb.json", codebook_txt="codebook_rgb.txt", global_mins=(0,0,0), global_maxs=(255,255,255)):
@@ -80,14 +86,76 @@ def generate_codebook_uniform_rgb(basename,bits=2, codebook_json="codebook_rgb.j
             f.write("\n")
     print(f"Codebooks saved: {codebook_json}, {codebook_txt}")
 
-def find_quant_index(err, codebook):
-    for entry in codebook:
-        rmin, rmax = entry['range']
-        if rmin <= err <= rmax:
-            return entry['code']
-    return 0 if err < codebook[0]['range'][0] else codebook[-1]['code']
+ERROR_OFFSET = 255 # prediction errors u(n) - u'(n) of 8 bit pixels lie in -255..255
+
+# lookup tables of the R, G, B codebooks:
+#  index_table[c, err + ERROR_OFFSET] is the quantization index of every possible error of channel c
+#  (the first range holding the error, else 0 below the first range and the last code above it)
+#  midpoints[c, q_index] is the dequantized error of an index
+def load_quantizer_tables(codebook_json):
+    with open(codebook_json, "r") as f:
+        codebooks = json.load(f)
+    channels = [codebooks[ch] for ch in ['R', 'G', 'B']]
+    rmins = np.array([[entry['range'][0] for entry in cb] for cb in channels], dtype=np.float64)[:, None, :]
+    rmaxs = np.array([[entry['range'][1] for entry in cb] for cb in channels], dtype=np.float64)[:, None, :]
+    midpoints = np.array([[entry['midpoint'] for entry in cb] for cb in channels], dtype=np.float64)
+
+    err = np.arange(-ERROR_OFFSET, ERROR_OFFSET + 1)[None, :, None]
+    inside = (rmins <= err) & (err <= rmaxs)
+    fallback = np.where(err[..., 0] < rmins[..., 0], 0, midpoints.shape[1] - 1)
+    index_table = np.where(inside.any(axis=-1), inside.argmax(axis=-1), fallback).astype(np.int32)
+    return index_table, midpoints
+
+# row and column indices of every anti-diagonal (i + j = d) of an h x w image, top-right to bottom-left
+def anti_diagonals(h, w):
+    for d in range(h + w - 1):
+        ii = np.arange(max(0, d - w + 1), min(h - 1, d) + 1)
+        yield ii, d - ii
+
+# loco_predict for all pixels of one anti-diagonal from what has been reconstructed so far, shape (n, 3)
+def predict_diagonal(reconstructed, ii, jj):
+    pred = reconstructed[ii, jj] # first row and column, as in loco_predict
+    inner = (ii > 0) & (jj > 0)
+    i, j = ii[inner], jj[inner]
+    pred[inner] = med_predict(reconstructed[i, j-1], reconstructed[i-1, j], reconstructed[i-1, j-1])
+    return pred
+
+# first row of every band when the image is cut into horizontal strips of strip_rows rows (one band without strips)
+def band_starts(h, strip_rows=None):
+    if strip_rows is None or strip_rows >= h:
+        return [0]
+    if strip_rows <= 0:
+        raise ValueError("strip_rows must be >= 1")
+    return list(range(0, h, strip_rows))
+
+# runs fn on the arguments of every band, in a process pool when there is more than one band
+def map_bands(fn, bands, workers=None):
+    if len(bands) == 1:
+        return [fn(*bands[0])]
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        return list(pool.map(fn, *zip(*bands)))
+
+# raises ValueError unless starts are strictly increasing band starts from row 0 inside an image of h rows
+def check_band_starts(starts, h):
+    if not starts or starts[0] != 0 or any(b <= a for a, b in zip(starts, starts[1:])) or starts[-1] >= h:
+        raise ValueError(f"Invalid band starts {starts} for an image of {h} rows.")
 
 def compress_rgb(original_img, codebook_json):
+    index_table, midpoints = load_quantizer_tables(codebook_json)
+    return compress_band(original_img, index_table, midpoints)
+
+# strip mode: the image is cut into bands of strip_rows rows and every band restarts prediction at its first row
+# the way row 0 is treated, so the bands are independent and are coded in parallel by up to workers processes
+# returns the same images as compress_rgb plus the first row of every band, to be saved with save_quantized_bin
+def compress_rgb_strips(original_img, codebook_json, strip_rows, workers=None):
+    h = original_img.shape[0]
+    index_table, midpoints = load_quantizer_tables(codebook_json)
+    starts = band_starts(h, strip_rows)
+    bands = [(original_img[r0:r1], index_table, midpoints) for r0, r1 in zip(starts, starts[1:] + [h])]
+    results = map_bands(compress_band, bands, workers)
+    return tuple(np.concatenate(parts) for parts in zip(*results)) + (starts,)
+
+def compress_band(original_img, index_table, midpoints):
     h, w, _ = original_img.shape
     # creates empty arrays that we will use to create he images later
     reconstructed = np.zeros_like(original_img, dtype=np.int32)
@@ -97,41 +165,41 @@ def compress_rgb(original_img, codebook_json):
     error = np.zeros_like(original_img, dtype=np.int32)
     q_image = np.zeros_like(original_img, dtype=np.int32)
 
-    with open(codebook_json, "r") as f:
-        codebooks = json.load(f)
-    channels = ['R','G','B']
+    channels = np.arange(3)
 
-    # for each pixel in the image we predict is value for each channnel
-    for i in range(h):
-        for j in range(w):
-            for c_idx, ch in enumerate(channels):
+    # a pixel only depends on its left, top and top-left neighbours, which all lie on earlier anti-diagonals,
+    # so each diagonal is predicted and quantized in one step for all its pixels and channels
+    for ii, jj in anti_diagonals(h, w):
+        pred = predict_diagonal(reconstructed, ii, jj) # u'(n) = u^(n-1)
+        err = original_img[ii, jj] - pred  # e(n) = u(n) - u'(n)
+        q_index = index_table[channels, err + ERROR_OFFSET]
+        dq_err = midpoints[channels, q_index]
+        recon_pixel = np.clip(np.round(pred + dq_err), 0, 255) # u ^(n) = u'(n) + e^(n), valid range: 0 ≤ pixel ≤ 255
 
-                codebook = codebooks[ch] # get the codebook for current channel
-                pred = loco_predict(reconstructed, i, j, c_idx) # u'(n) = u^(n-1)
-                err = original_img[i, j, c_idx] - pred  # e(n) = u(n) - u'(n)
-                q_index = find_quant_index(err, codebook) 
-                dq_err = codebook[q_index]['midpoint'] 
-                recon_pixel = pred + dq_err # u ^(n) = u'(n) + e^(n)
-                recon_pixel = max(0, min(255, int(round(recon_pixel)))) # valid range: 0 ≤ pixel ≤ 255
-
-
-
-                reconstructed[i, j, c_idx] = recon_pixel
-                quant_indices[i, j, c_idx] = q_index
-                predicted[i,j,c_idx] = pred
-                error[i,j,c_idx] = err
-                q_image[i,j,c_idx] = dq_err
+        reconstructed[ii, jj] = recon_pixel
+        quant_indices[ii, jj] = q_index
+        predicted[ii, jj] = pred
+        error[ii, jj] = err
+        q_image[ii, jj] = dq_err
 
     return reconstructed, quant_indices, predicted, error, q_image
 
-def save_quantized_bin(basename, quant_indices):
+# starts are the band starts returned by compress_rgb_strips
+def save_quantized_bin(basename, quant_indices, starts=(0,)):
     h, w, _ = quant_indices.shape
     bin_path = os.path.join(script_dir, f"{basename}_quant.bin")
+    starts = list(starts)
+    check_band_starts(starts, h)
 
     with open(bin_path, "wb") as f:
         # image dimensions
         f.write(np.int32(h).tobytes())
         f.write(np.int32(w).tobytes())
+
+        # strip mode: number of bands and the first row of each (files without strips keep the old header)
+        if len(starts) > 1:
+            f.write(np.int32(len(starts)).tobytes())
+            f.write(np.array(starts, dtype=np.int32).tobytes())
         
         # Flatten array and save as int then as binary 
         flat = quant_indices.astype(np.uint8).flatten()
@@ -198,17 +266,15 @@ def save_images_decompress(basename, quant_indices, q_image, reconstructed):
         f" - {basename}_Decompressed_reconstructed.png"
     )
     
-def decompress_rgb(basename, codebook_json):
+# bands written in strip mode are decoded in parallel by up to workers processes
+def decompress_rgb(basename, codebook_json, workers=None):
 
     bin_path = os.path.join(script_dir, f"{basename}_quant.bin")
     if not os.path.exists(bin_path):
         raise FileNotFoundError(f"Binary quantized file not found: {bin_path}")
 
-    # Load codebook
-    with open(codebook_json, "r") as f:
-        codebooks = json.load(f)
-
-    channels = ['R', 'G', 'B']
+    # Load codebook: one array of midpoints per channel
+    midpoints = load_quantizer_tables(codebook_json)[1]
 
     # Read binary file
     with open(bin_path, "rb") as f:
@@ -221,32 +287,48 @@ def decompress_rgb(basename, codebook_json):
         w = np.frombuffer(header_w, dtype=np.int32)[0]
 
         # read remaining bytes
-        flat = np.frombuffer(f.read(), dtype=np.uint8)
+        data = f.read()
+
+    # band table of strip mode, present when there are more bytes than indices
+    starts = [0]
+    if len(data) != h * w * 3:
+        n_bands = int(np.frombuffer(data[:4], dtype=np.int32)[0]) if len(data) >= 4 else 0
+        if n_bands <= 0 or len(data) != 4 + 4 * n_bands + h * w * 3:
+            raise ValueError("Invalid .bin file: size doesn't match the header.")
+        starts = np.frombuffer(data[4:4 + 4 * n_bands], dtype=np.int32).tolist()
+        data = data[4 + 4 * n_bands:]
+        try:
+            check_band_starts(starts, h)
+        except ValueError as e:
+            raise ValueError(f"Invalid .bin file: {e}")
+    flat = np.frombuffer(data, dtype=np.uint8)
 
     # Reshape to H x W x 3 and convert to int32 for reconstruction
     quant_indices = flat.reshape((h, w, 3)).astype(np.int32)
 
-    reconstructed = np.zeros((h, w, 3), dtype=np.int32)
-    q_image = np.zeros((h, w, 3), dtype=np.int32)  # will hold dequantized error midpoints
-
-    for i in range(h):
-        for j in range(w):
-            for c_idx, ch in enumerate(channels):
-                pred = loco_predict(reconstructed, i, j, c_idx)
+    bands = [(quant_indices[r0:r1], midpoints) for r0, r1 in zip(starts, starts[1:] + [h])]
+    results = map_bands(decompress_band, bands, workers)
+    reconstructed, q_image = (np.concatenate(parts) for parts in zip(*results))
+    return reconstructed, quant_indices, q_image
 
-                q_index = int(quant_indices[i, j, c_idx])
-                q_index = max(0, min(q_index, len(codebooks[ch]) - 1))
+def decompress_band(quant_indices, midpoints):
+    h, w, _ = quant_indices.shape
+    channels = np.arange(3)
 
-                # read dequantized error (midpoint) from codebook
-                dq_err = float(codebooks[ch][q_index]["midpoint"])
-                q_image[i, j, c_idx] = int(round(dq_err))
+    reconstructed = np.zeros((h, w, 3), dtype=np.int32)
+    q_image = np.zeros((h, w, 3), dtype=np.int32)  # will hold dequantized error midpoints
 
-                recon_pixel = pred + dq_err
-                recon_pixel = max(0, min(255, int(round(recon_pixel))))
+    # dequantized errors don't depend on the prediction, so they are read for the whole image at once
+    q_index = np.minimum(quant_indices, midpoints.shape[1] - 1)
+    dq_image = midpoints[channels, q_index]
+    q_image[:] = np.round(dq_image)
 
-                reconstructed[i, j, c_idx] = recon_pixel
+    # same anti-diagonal order as compress_rgb
+    for ii, jj in anti_diagonals(h, w):
+        pred = predict_diagonal(reconstructed, ii, jj)
+        reconstructed[ii, jj] = np.clip(np.round(pred + dq_image[ii, jj]), 0, 255)
 
-    return reconstructed, quant_indices, q_image
+    return reconstructed, q_image
 
 
 
@@ -279,6 +361,15 @@ if __name__ == "__main__":
                 print("Invalid number of bits.")
                 continue
 
+            strip_rows = input("Rows per strip for parallel coding (blank for none): ").strip()
+            try:
+                strip_rows = int(strip_rows) if strip_rows else None
+                if strip_rows is not None and strip_rows <= 0:
+                    raise ValueError
+            except:
+                print("Invalid number of rows.")
+                continue
+
             print("Running analysis pass...")
             global_min, global_max = analysis_pass(image_path)
             print("Global min errors:", [int(x) for x in global_min])
@@ -297,11 +388,15 @@ if __name__ == "__main__":
 
             codebook_path = os.path.join(script_dir, basename + "codebook_rgb.json")
 
-            reconstructed, quant_indices, predicted, error, q_image = compress_rgb(
-                img, codebook_path
-            )
+            if strip_rows is None:
+                reconstructed, quant_indices, predicted, error, q_image = compress_rgb(img, codebook_path)
+                starts = [0]
+            else:
+                reconstructed, quant_indices, predicted, error, q_image, starts = compress_rgb_strips(
+                    img, codebook_path, strip_rows
+                )
 
-            save_quantized_bin(basename, quant_indices)
+            save_quantized_bin(basename, quant_indices, starts)
             save_images(basename, predicted, error, quant_indices, q_image, reconstructed)
             print("Compression completed!")
 
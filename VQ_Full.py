@@ -1,107 +1,404 @@
+import glob
+from collections import deque
+import heapq
 import json
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from concurrent.futures.process import BrokenProcessPool
+from functools import cached_property
 import numpy as np
 from PIL import Image
 from scipy.spatial.distance import cdist
 import os
 import math
 import struct
+import zlib
 
 script_dir = os.path.dirname(os.path.abspath(__file__))  # script working directory
 
-class Codebook:
-    def __init__(self, path, block_h, block_w):
-        self.path = path
-        self.block_h = block_h
-        self.block_w = block_w
+DEFAULT_MEMORY_BUDGET = 64 * 1024 * 1024  # bytes allowed for one tile of the distance matrix
 
-        img = Image.open(self.path).convert("RGB") # opens image as a RGB array
-        self.img_arr = np.array(img)
-        self.orig_h, self.orig_w, self.channels = self.img_arr.shape
+# compressed container: header, raw codebook, labels (fixed-width bit-packed or Huffman coded)
+# header = magic, original height, original width, block height, block width, channels, k, bits per label,
+#          codebook dtype code, label coding code
+CONTAINER_MAGIC = b"VQC1"
+CONTAINER_HEADER = struct.Struct("<4sIIHHBIBBB")
+CONTAINER_DTYPES = {"uint8": 0, "float16": 1, "shared": 2}  # "shared" stores only a CRC-32 of an external codebook
+LABEL_CODINGS = {"fixed": 0, "huffman": 1}  # huffman stores one code length byte per codevector before the bit stream
+HUFFMAN_MAX_BITS = 16  # longest Huffman code, keeps the decoder lookup table at 64K entries
+# _labels.bin starts with the label grid shape and the bits per label so it can be decoded on its own
+LABELS_BIN_MAGIC = b"VQL1" # tells headed _labels.bin files from the headerless ones of older versions
+LABELS_BIN_HEADER = struct.Struct("<4sIIIIB")  # magic, rows, columns, original height, original width, bits per label
 
 
-        # pads the image so that its dimensions are multiples of block size
-        pad_h = (self.block_h - (self.orig_h % self.block_h)) % self.block_h
-        pad_w = (self.block_w - (self.orig_w % self.block_w)) % self.block_w
+# Manhattan distances between a tile of blocks and every codevector
+def codevector_distances(tile, codebook):
+    return cdist(tile, codebook, metric="cityblock")
 
 
-        # pads the image using edge pixels to avoid adding new colors to the image
-        self.img_padded = np.pad(
-            self.img_arr,
-            ((0, pad_h), (0, pad_w), (0, 0)),
-            mode="edge",
-            #constant_values=0
+# number of blocks per tile so that one tile of distances stays inside the memory budget
+def tile_rows(blocks, codebook, memory_budget):
+    # a row costs one float64 per codevector plus the float64 copy of the block cdist makes
+    row_bytes = 8 * (len(codebook) + blocks.shape[1])
+    return max(1, memory_budget // row_bytes)
+
+
+# finds the nearest codevector of every block by streaming the blocks through cdist in tiles
+# only the running argmin and min distance of each tile is kept, so peak memory is set by the budget
+def nearest_codevectors(blocks, codebook, memory_budget=DEFAULT_MEMORY_BUDGET):
+    n = len(blocks)
+    labels = np.empty(n, dtype=np.int64)
+    min_distances = np.empty(n, dtype=np.float64)
+    if n == 0:
+        return labels, min_distances
+
+    chunk = tile_rows(blocks, codebook, memory_budget)
+    for start in range(0, n, chunk):
+        stop = min(start + chunk, n)
+        distances = codevector_distances(blocks[start:stop], codebook)
+        tile_labels = np.argmin(distances, axis=1)
+        labels[start:stop] = tile_labels
+        min_distances[start:stop] = distances[np.arange(stop - start), tile_labels]
+    return labels, min_distances
+
+
+# same as nearest_codevectors but also returns the distance to the second nearest codevector
+def nearest_two_codevectors(blocks, codebook, memory_budget=DEFAULT_MEMORY_BUDGET):
+    n = len(blocks)
+    labels = np.empty(n, dtype=np.int64)
+    min_distances = np.empty(n, dtype=np.float64)
+    second_distances = np.full(n, np.inf)
+    if n == 0:
+        return labels, min_distances, second_distances
+
+    chunk = tile_rows(blocks, codebook, memory_budget)
+    for start in range(0, n, chunk):
+        stop = min(start + chunk, n)
+        distances = codevector_distances(blocks[start:stop], codebook)
+        rows = np.arange(stop - start)
+        tile_labels = np.argmin(distances, axis=1)
+        labels[start:stop] = tile_labels
+        min_distances[start:stop] = distances[rows, tile_labels]
+        if len(codebook) > 1:
+            distances[rows, tile_labels] = np.inf
+            second_distances[start:stop] = distances.min(axis=1)
+    return labels, min_distances, second_distances
+
+
+# Manhattan distance between each block and one given codevector per block, in tiles
+def assigned_distances(blocks, codebook, labels, memory_budget=DEFAULT_MEMORY_BUDGET):
+    n = len(blocks)
+    distances = np.empty(n, dtype=np.float64)
+    chunk = max(1, memory_budget // (16 * blocks.shape[1]))
+    for start in range(0, n, chunk):
+        stop = min(start + chunk, n)
+        diff = blocks[start:stop] - codebook[labels[start:stop]]
+        distances[start:stop] = np.abs(diff).sum(axis=1)
+    return distances
+
+
+# mean squared pixel error of each block against one given codevector per block, in tiles
+def assigned_squared_errors(blocks, codebook, labels, memory_budget=DEFAULT_MEMORY_BUDGET):
+    n = len(blocks)
+    errors = np.empty(n, dtype=np.float64)
+    chunk = max(1, memory_budget // (16 * blocks.shape[1]))
+    for start in range(0, n, chunk):
+        stop = min(start + chunk, n)
+        diff = blocks[start:stop] - codebook[labels[start:stop]].astype(np.float64)
+        errors[start:stop] = np.mean(diff * diff, axis=1)
+    return errors
+
+
+# Hamerly-style accelerated assignment for the Manhattan LBG loop
+# upper[i] is the exact distance of block i to its codevector, lower[i] a lower bound on its distance to every other one
+# a block whose upper distance is below both lower[i] and half the gap to the nearest other codevector
+# cannot change cluster, so only the remaining blocks go through the full search
+class BoundedAssignment:
+    def __init__(self, blocks, memory_budget=DEFAULT_MEMORY_BUDGET):
+        self.blocks = blocks
+        self.memory_budget = memory_budget
+        self.labels = None
+        self.upper = None
+        self.lower = None
+
+    def assign(self, codebook):
+        if self.labels is None:
+            self.labels, self.upper, self.lower = nearest_two_codevectors(self.blocks, codebook, self.memory_budget)
+            return self.labels.copy(), self.upper.copy()
+
+        self.upper = assigned_distances(self.blocks, codebook, self.labels, self.memory_budget)
+        if len(codebook) > 1:
+            centre_gaps = cdist(codebook, codebook, metric="cityblock")
+            np.fill_diagonal(centre_gaps, np.inf)
+            half_gap = centre_gaps.min(axis=1) / 2
+            bound = np.maximum(self.lower, half_gap[self.labels])
+            # strict test with a little slack for rounding, so ties are always re-searched like argmin would
+            stale = np.flatnonzero(self.upper >= bound - 1e-9 * (1 + np.abs(bound)))
+        else:
+            stale = np.arange(0)
+
+        if len(stale) > 0:
+            labels, upper, lower = nearest_two_codevectors(self.blocks[stale], codebook, self.memory_budget)
+            self.labels[stale] = labels
+            self.upper[stale] = upper
+            self.lower[stale] = lower
+        return self.labels.copy(), self.upper.copy()
+
+    # loosens the bounds after the codevectors moved from old to new
+    def moved(self, old_codebook, new_codebook):
+        if self.labels is None:
+            return
+        shift = np.abs(new_codebook - old_codebook).sum(axis=1)
+        if len(shift) < 2:
+            return
+        # every block is pushed down by the largest shift among the other codevectors
+        order = np.argsort(shift)
+        largest, second_largest = order[-1], order[-2]
+        other_shift = np.where(self.labels == largest, shift[second_largest], shift[largest])
+        self.lower -= other_shift
+
+    # carries the bounds over an LBG split: codevector j becomes j (plus branch) and j + K (minus branch)
+    def split(self, old_codebook, new_codebook):
+        if self.labels is None:
+            return
+        k = len(old_codebook)
+        shift = np.maximum(
+            np.abs(new_codebook[:k] - old_codebook).sum(axis=1),
+            np.abs(new_codebook[k:] - old_codebook).sum(axis=1),
         )
+        # blocks stay on the plus branch; the minus sibling is the only codevector the old bound says nothing about
+        siblings = assigned_distances(self.blocks, new_codebook, self.labels + k, self.memory_budget)
+        self.lower = np.minimum(self.lower - shift.max(), siblings)
+
+
+# moves every codevector to the mean of its members using one bincount per dimension
+# weights are per-block occurrence counts when the blocks were deduplicated
+# codevectors that got no members keep their old value
+def update_centroids(blocks, labels, codebook, weights=None):
+    k = len(codebook)
+    counts = np.bincount(labels, weights=weights, minlength=k)
+    sums = np.empty(codebook.shape, dtype=np.float64)
+    for d in range(blocks.shape[1]):
+        column = blocks[:, d] if weights is None else blocks[:, d] * weights
+        sums[:, d] = np.bincount(labels, weights=column, minlength=k)
+
+    new_codebook = codebook.copy()
+    filled = counts > 0
+    new_codebook[filled] = sums[filled] / counts[filled, None]
+    return new_codebook
+
+
+# one step down the LBG split tree: node j of the parent level has children j (plus branch) and j + K (minus branch)
+# each block only compares the two children of its parent node
+def split_assign(blocks, codebook, parents, memory_budget=DEFAULT_MEMORY_BUDGET):
+    n = len(blocks)
+    half = len(codebook) // 2
+    labels = np.empty(n, dtype=np.int64)
+    min_distances = np.empty(n, dtype=np.float64)
+    chunk = max(1, memory_budget // (32 * blocks.shape[1]))
+    for start in range(0, n, chunk):
+        stop = min(start + chunk, n)
+        tile = blocks[start:stop]
+        node = parents[start:stop]
+        plus = np.abs(tile - codebook[node]).sum(axis=1)
+        minus = np.abs(tile - codebook[node + half]).sum(axis=1)
+        go_minus = minus < plus # ties stay on the plus branch like argmin would
+        labels[start:stop] = np.where(go_minus, node + half, node)
+        min_distances[start:stop] = np.where(go_minus, minus, plus)
+    return labels, min_distances
+
 
+# tree-structured search: walks the levels kept by generate_codebook (sizes 1, 2, 4, ..., K)
+# so every block costs 2 * log2(K) distances instead of K
+def tree_search(blocks, levels, memory_budget=DEFAULT_MEMORY_BUDGET):
+    labels = np.zeros(len(blocks), dtype=np.int64)
+    min_distances = assigned_distances(blocks, levels[0], labels, memory_budget)
+    for level in levels[1:]:
+        labels, min_distances = split_assign(blocks, level, labels, memory_budget)
+    return labels, min_distances
+
+class Codebook:
+    def __init__(self, path, block_h, block_w, memory_budget=DEFAULT_MEMORY_BUDGET, tree=False, dedupe=False,
+                 legacy_outputs=False, blocks=None, allow_huge=False):
+        self.path = path
+        self.block_h = block_h
+        self.block_w = block_w
+        self.memory_budget = memory_budget # max bytes used by one tile of block-to-codevector distances
+        self.use_tree = tree # tree-structured VQ: saves the split tree and encodes by walking it
+        self.dedupe = dedupe # trains and assigns on unique blocks weighted by how often they occur
+        self.legacy_outputs = legacy_outputs # also writes the old _codebook.json, _labels.json and _labels.bin files
+        # lifts PIL's decompression-bomb limit for the header probe and compress_streaming only;
+        # decoding the whole image into blocks keeps the limit
+        self.allow_huge = allow_huge
+
+        self.channels = 3 # images are always converted to RGB
+        if blocks is not None:
+            # trains on a given block matrix (e.g. blocks sampled from many images), seen as one column of blocks;
+            # path only names the outputs
+            self.blocks = blocks
+            self.orig_h, self.orig_w = len(blocks) * self.block_h, self.block_w
+        else:
+            # only the header is read here; decoding, padding and block extraction wait until the blocks are needed
+            self.orig_h, self.orig_w = probe_image(self.path, allow_huge)
+        self.from_blocks = blocks is not None
+
+        # pads the image so that its dimensions are multiples of block size
+        self.pad_h = (self.block_h - (self.orig_h % self.block_h)) % self.block_h
+        self.pad_w = (self.block_w - (self.orig_w % self.block_w)) % self.block_w
+        self.padded_h = self.orig_h + self.pad_h
+        self.padded_w = self.orig_w + self.pad_w
 
-        self.padded_h, self.padded_w, _ = self.img_padded.shape
-        self.blocks = self.image_to_blocks()
         self.codebook = None
+        self.tree = None # codebooks of every split level, from the single centroid up to the final codebook
+        self.distortion = None # mean Manhattan distortion reached by the last generate_codebook call
         self.n_rows = self.padded_h // self.block_h
         self.n_cols = self.padded_w // self.block_w
+        self.n_blocks = self.n_rows * self.n_cols
 
         # Output files
         self.base_name = os.path.splitext(os.path.basename(self.path))[0]
         self.codebook_json = os.path.join(script_dir, f"{self.base_name}_codebook.json")
         self.codebook_txt = os.path.join(script_dir, f"{self.base_name}_codebook.txt")
+        self.tree_json = os.path.join(script_dir, f"{self.base_name}_tree.json")
         self.labels_json = os.path.join(script_dir, f"{self.base_name}_labels.json")
         self.labels_bin = os.path.join(script_dir, f"{self.base_name}_labels.bin")
+        self.container_path = os.path.join(script_dir, f"{self.base_name}.vqc")
         self.reconstructed_path = os.path.join(script_dir, f"{self.base_name}_reconstructed.png")
 
+    # the decoded and padded images are not cached: only the block matrix built from them is kept
+    @property
+    def img_arr(self):
+        img = Image.open(self.path).convert("RGB") # opens image as a RGB array
+        return np.array(img)
+
+    @property
+    def img_padded(self):
+        if self.pad_h == 0 and self.pad_w == 0: # nothing to pad, skips the extra copy
+            return self.img_arr
+        # pads the image using edge pixels to avoid adding new colors to the image
+        return np.pad(
+            self.img_arr,
+            ((0, self.pad_h), (0, self.pad_w), (0, 0)),
+            mode="edge",
+            #constant_values=0
+        )
+
+    @cached_property
+    def blocks(self):
+        return self.image_to_blocks()
+
+    # unique training vectors, their counts and the inverse index (see training_vectors)
+    @cached_property
+    def training_set(self):
+        return self.training_vectors()
+
+    @property
+    def vectors(self):
+        return self.training_set[0]
+
+    @property
+    def counts(self):
+        return self.training_set[1]
+
+    @property
+    def inverse(self):
+        return self.training_set[2]
+
     # creates blocks from the padded image
     def image_to_blocks(self):
-        h, w, c = self.img_padded.shape
-        n_rows = h // self.block_h
-        n_cols = w // self.block_w
-        blocks = self.img_padded.reshape(n_rows, self.block_h, n_cols, self.block_w, c)
+        padded = self.img_padded # decodes the image once; img_padded is not cached
+        blocks = padded.reshape(self.n_rows, self.block_h, self.n_cols, self.block_w, self.channels)
         blocks = blocks.swapaxes(1, 2)
-        return blocks.reshape(-1, self.block_h * self.block_w * c)
+        return blocks.reshape(-1, self.block_h * self.block_w * self.channels)
+
+    # collapses identical blocks into unique vectors with their occurrence counts
+    # inverse maps every block back to its unique vector, so labels of the unique set expand to all blocks
+    def training_vectors(self):
+        if not self.dedupe:
+            return self.blocks, None, None
+        vectors, inverse, counts = np.unique(self.blocks, axis=0, return_inverse=True, return_counts=True)
+        print(f"Deduplicated {len(self.blocks)} blocks into {len(vectors)} unique vectors")
+        return vectors, counts.astype(np.float64), inverse.reshape(-1)
+
+    # expands labels and distances of the training vectors to one entry per block
+    def expand(self, values):
+        return values if self.inverse is None else values[self.inverse]
+
+    # mean over all blocks of a per-vector value, counting duplicates
+    def block_mean(self, values):
+        return float(np.average(values, weights=self.counts))
 
     
-    def generate_codebook(self, k, epsilon=0.01, threshold=0.001, max_iterations=100):
-        if k > len(self.blocks):
+    # stop_when(self) is asked before every split and ends the splitting early when it returns True
+    # save=False skips writing the output files (see save_codebook)
+    # accelerate switches on the BoundedAssignment bounds: same labels, but the gain depends on the image
+    # (it can be slower than the plain search when most blocks sit near a cluster boundary), so it is opt-in
+    def generate_codebook(self, k, epsilon=0.01, threshold=0.001, max_iterations=100,
+                          batch_size=None, refine=True, seed=None, accelerate=False, stop_when=None, save=True):
+        if k > self.n_blocks:
             raise ValueError(
-                f"Invalid quantization level k={k}: cannot exceed the total number of image blocks ({len(self.blocks)})."
+                f"Invalid quantization level k={k}: cannot exceed the total number of image blocks ({self.n_blocks})."
             )
 
+        # mini-batch mode only makes sense when the batch is smaller than the image
+        mini_batch = batch_size is not None and batch_size < self.n_blocks
+        rng = np.random.default_rng(seed)
+        # triangle-inequality bounds kept across iterations and split stages (same labels as the full search)
+        assigner = None
+        if accelerate and not mini_batch and not self.use_tree:
+            assigner = BoundedAssignment(self.vectors, self.memory_budget)
+        parents = None # in tree mode each block may only move between the two children of its parent
+
         print(f"\n=== Starting LBG for k={k} ===")
-        centroid = np.mean(self.blocks, axis=0) # gets the mean of all blocks as the initial centroid
+        centroid = np.average(self.vectors, axis=0, weights=self.counts) # gets the mean of all blocks as the initial centroid
         self.codebook = np.array([centroid]) # initializes the codebook with the centroid
+        self.tree = [self.codebook.copy()]
+        self.distortion = None
 
         while len(self.codebook) < k: # while the codebook hasn't reached the desired level of quantization
+            if stop_when is not None and stop_when(self):
+                print(f"Stopped splitting at k={len(self.codebook)}")
+                break
             code_plus = self.codebook * (1 + epsilon) # right branch (adds a small value for percision)
             code_minus = self.codebook * (1 - epsilon) # left branch (subtracts a small value for percision)
+            parent = self.codebook
             self.codebook = np.vstack((code_plus, code_minus)) # adds the new branches to the codebook underneath the old ones
+            if self.use_tree:
+                parents, _ = tree_search(self.vectors, self.tree, self.memory_budget)
 
-            prev_distortion = float('inf') # association level is first set to infinity
-            for i in range(max_iterations):
-                distances = cdist(self.blocks, self.codebook, metric='cityblock') # calculates the Manhattan distance between each block and each codevector
-                labels = np.argmin(distances, axis=1)
-                new_codebook = np.zeros_like(self.codebook)
-
-                for idx in range(len(self.codebook)): # assigns each block to the nearest codevector
-                    members = self.blocks[labels == idx]
-                    if len(members) > 0:
-                        new_codebook[idx] = np.mean(members, axis=0)
-                    else:
-                        new_codebook[idx] = self.codebook[idx]
-
-                self.codebook = new_codebook
-                min_distances = distances[np.arange(len(distances)), labels] 
-                distortion = np.mean(min_distances)
+            if mini_batch:
+                self.minibatch_iterations(batch_size, rng, threshold, max_iterations, parents)
+            else:
+                if assigner is not None:
+                    assigner.split(parent, self.codebook)
+                self.distortion = self.lbg_iterations(threshold, max_iterations, assigner, parents)
+            self.tree.append(self.codebook.copy()) # keeps the converged level so the split tree can be searched later
 
-                if prev_distortion != float('inf'): # checks for no more movement in association level 
-                    change = abs(prev_distortion - distortion) / prev_distortion
-                    if change < threshold:
-                        print(f"Converged at iter {i}, distortion={distortion:.3f}")
-                        break
+        if mini_batch and refine: # final full-data pass to polish the mini-batch codebook
+            print("Refining on all blocks...")
+            assigner = BoundedAssignment(self.vectors, self.memory_budget) if accelerate and not self.use_tree else None
+            self.distortion = self.lbg_iterations(threshold, max_iterations, assigner, parents)
+            self.tree[-1] = self.codebook.copy()
+        elif self.distortion is None or mini_batch: # measures the distortion actually reached on all blocks
+            if self.use_tree:
+                _, min_distances = tree_search(self.vectors, self.tree, self.memory_budget)
+            else:
+                _, min_distances = nearest_codevectors(self.vectors, self.codebook, self.memory_budget)
+            self.distortion = self.block_mean(min_distances)
+        print(f"Final distortion={self.distortion:.3f}")
 
-                prev_distortion = distortion
+        if save:
+            self.save_codebook()
+        return self.codebook.reshape(-1, self.block_h, self.block_w, self.channels).tolist()
 
+    # writes the codebook TXT table, the split tree in tree mode and the old JSON codebook with legacy_outputs
+    def save_codebook(self):
         # Save codebook as JSON
         final = self.codebook.reshape(-1, self.block_h, self.block_w, self.channels).tolist()
-        with open(self.codebook_json, "w") as f:
-            json.dump(final, f, indent=4)
-        print(f"✓ Codebook saved to JSON: {self.codebook_json}")
+        if self.legacy_outputs:
+            with open(self.codebook_json, "w") as f:
+                json.dump(final, f, indent=4)
+            print(f"✓ Codebook saved to JSON: {self.codebook_json}")
 
         # Save codebook as TXT table
         with open(self.codebook_txt, "w") as f:
@@ -114,63 +411,780 @@ class Codebook:
                 f.write(f"{idx:<6}{min_val:>10.2f}{max_val:>10.2f}{dequant_val:>30.2f}\n")
         print(f"✓ Codebook saved as formatted TXT: {self.codebook_txt}")
 
-        return final
+        # Save the split tree, one codebook per level
+        if self.use_tree:
+            levels = [level.reshape(-1, self.block_h, self.block_w, self.channels).tolist() for level in self.tree]
+            with open(self.tree_json, "w") as f:
+                json.dump(levels, f)
+            print(f"✓ Split tree saved to JSON: {self.tree_json}")
+
+    # full-batch LBG: reassigns every block and recomputes every codevector until the distortion settles
+    def lbg_iterations(self, threshold, max_iterations, assigner=None, parents=None):
+        prev_distortion = float('inf') # association level is first set to infinity
+        for i in range(max_iterations):
+            # calculates the Manhattan distance between each block and each codevector, tile by tile
+            if parents is not None:
+                labels, min_distances = split_assign(self.vectors, self.codebook, parents, self.memory_budget)
+            elif assigner is not None:
+                labels, min_distances = assigner.assign(self.codebook)
+            else:
+                labels, min_distances = nearest_codevectors(self.vectors, self.codebook, self.memory_budget)
+            # moves each codevector to the mean of its blocks
+            new_codebook = update_centroids(self.vectors, labels, self.codebook, self.counts)
+            if assigner is not None:
+                assigner.moved(self.codebook, new_codebook)
+            self.codebook = new_codebook
+            distortion = self.block_mean(min_distances)
+
+            if prev_distortion != float('inf'): # checks for no more movement in association level 
+                # a distortion of 0 (e.g. a flat image) cannot improve any more
+                change = abs(prev_distortion - distortion) / prev_distortion if prev_distortion > 0 else 0.0
+                if change < threshold:
+                    print(f"Converged at iter {i}, distortion={distortion:.3f}")
+                    break
+
+            prev_distortion = distortion
+        return distortion
+
+    # mini-batch LBG: each iteration only looks at a random sample of blocks
+    # every codevector moves towards the batch mean with a step of 1 / (blocks it has seen so far)
+    def minibatch_iterations(self, batch_size, rng, threshold, max_iterations, parents=None):
+        seen = np.zeros(len(self.codebook))
+        smoothed = None # the batch distortion is noisy so convergence is checked on a moving average
+        for i in range(max_iterations):
+            sample = rng.integers(0, self.n_blocks, batch_size)
+            if self.inverse is not None: # draws duplicates as often as they occur in the image
+                sample = self.inverse[sample]
+            batch = self.vectors[sample]
+            if parents is not None:
+                labels, min_distances = split_assign(batch, self.codebook, parents[sample], self.memory_budget)
+            else:
+                labels, min_distances = nearest_codevectors(batch, self.codebook, self.memory_budget)
+
+            counts = np.bincount(labels, minlength=len(self.codebook))
+            batch_means = update_centroids(batch, labels, self.codebook)
+            seen += counts
+            hit = counts > 0
+            step = (counts[hit] / seen[hit])[:, None]
+            self.codebook[hit] += step * (batch_means[hit] - self.codebook[hit])
 
-    # assigns each block to the nearest codevector and saves the labels
-    def compress(self):
+            distortion = float(np.mean(min_distances))
+            if smoothed is None:
+                smoothed = distortion
+                continue
+            prev_smoothed = smoothed
+            smoothed = 0.7 * smoothed + 0.3 * distortion
+            if prev_smoothed == 0 or abs(prev_smoothed - smoothed) / prev_smoothed < threshold:
+                print(f"Converged at iter {i}, batch distortion={smoothed:.3f}")
+                break
+        return smoothed
+
+    # assigns each block to the nearest codevector and saves the codebook and labels in one container
+    # codebook_dtype picks how the codebook is stored in it: "uint8" (rounded) or "float16"
+    # label_coding "huffman" entropy codes the labels instead of storing ceil(log2(k)) bits each
+    # codebook_dtype "shared" leaves the codebook out, for images encoded against a shared codebook (see load_codebook)
+    def compress(self, codebook_dtype="uint8", label_coding="fixed"):
         if self.codebook is None:
             raise ValueError("No codebook yet.")
+        if self.from_blocks:
+            raise ValueError("This codebook was trained on sampled blocks; encode each image with load_codebook instead.")
 
-        distances = cdist(self.blocks, self.codebook, metric="cityblock")
-        labels = np.argmin(distances, axis=1)
+        if self.use_tree: # walks the split tree instead of searching all K codevectors
+            labels, _ = tree_search(self.vectors, self.tree, self.memory_budget)
+        else:
+            labels, _ = nearest_codevectors(self.vectors, self.codebook, self.memory_budget)
+        labels = self.expand(labels)
         labels_grid = labels.reshape(self.n_rows, self.n_cols)
 
-        # Save labels as JSON
-        with open(self.labels_json, "w") as f:
-            json.dump(labels_grid.tolist(), f)
-        print(f"✓ Labels saved as JSON: {self.labels_json}")
-
-        # Save labels as binary
-        bits_needed = math.ceil(math.log2(len(self.codebook)))
-        binary_data = 0
-        bit_count = 0
-        with open(self.labels_bin, "wb") as f:
-            for lbl in labels.flatten():
-                binary_data = (binary_data << bits_needed) | lbl
-                bit_count += bits_needed
-                while bit_count >= 8:
-                    byte = (binary_data >> (bit_count - 8)) & 0xFF
-                    f.write(struct.pack("B", byte))
-                    bit_count -= 8
-            if bit_count > 0:
-                byte = (binary_data << (8 - bit_count)) & 0xFF
-                f.write(struct.pack("B", byte))
-        print(f"✓ Labels saved as binary: {self.labels_bin}")
+        write_container(self.container_path, self.orig_h, self.orig_w, self.block_h, self.block_w,
+                        self.codebook, labels, codebook_dtype, label_coding)
+        print(f"✓ Codebook and labels saved to container: {self.container_path}")
+
+        if self.legacy_outputs:
+            # Save labels as JSON
+            with open(self.labels_json, "w") as f:
+                json.dump(labels_grid.tolist(), f)
+            print(f"✓ Labels saved as JSON: {self.labels_json}")
+
+            # Save labels as binary
+            bits_needed = math.ceil(math.log2(len(self.codebook)))
+            with open(self.labels_bin, "wb") as f:
+                f.write(LABELS_BIN_HEADER.pack(LABELS_BIN_MAGIC, self.n_rows, self.n_cols, self.orig_h, self.orig_w,
+                                               bits_needed))
+                f.write(pack_labels(labels, bits_needed))
+            print(f"✓ Labels saved as binary: {self.labels_bin}")
 
         return labels_grid
 
+    # rate-distortion curve from a single LBG run: every split level 1, 2, 4, ..., K kept in self.tree is
+    # evaluated as a codebook of its own, with its distortion, MSE/PSNR and size in bytes
+    # with encode=True each level is also written as <name>_k<K>.vqc and the real file size is reported,
+    # otherwise the size of a fixed-width container is computed
+    def rate_distortion_sweep(self, k, encode=False, codebook_dtype="uint8", label_coding="fixed", **lbg_options):
+        self.generate_codebook(k, **lbg_options)
+        final_codebook = self.codebook
+
+        curve = []
+        for depth, level in enumerate(self.tree):
+            point, labels = self.level_point(depth)
+            if encode:
+                path = os.path.join(script_dir, f"{self.base_name}_k{len(level)}.vqc")
+                write_container(path, self.orig_h, self.orig_w, self.block_h, self.block_w,
+                                level, self.expand(labels), codebook_dtype, label_coding)
+                point["path"] = path
+                point["bytes"] = os.path.getsize(path)
+                point["bits_per_pixel"] = 8 * point["bytes"] / (self.orig_h * self.orig_w)
+            curve.append(point)
+
+        self.codebook = final_codebook
+        print(f"{'K':>6}{'Distortion':>12}{'PSNR':>8}{'Bytes':>12}{'bpp':>8}")
+        for point in curve:
+            print(f"{point['k']:>6}{point['distortion']:>12.3f}{point['psnr']:>8.2f}{point['bytes']:>12}{point['bits_per_pixel']:>8.3f}")
+        return curve
+
+    # evaluates level depth of the split tree as a codebook: returns its rate-distortion point and labels
+    # bytes is the size of a fixed-width container with a uint8 codebook
+    def level_point(self, depth):
+        level = self.tree[depth]
+        if self.use_tree:
+            labels, min_distances = tree_search(self.vectors, self.tree[:depth + 1], self.memory_budget)
+        else:
+            labels, min_distances = nearest_codevectors(self.vectors, level, self.memory_budget)
+        mse = self.block_mean(assigned_squared_errors(self.vectors, level, labels, self.memory_budget))
+        size = container_size(len(level), self.block_h, self.block_w, self.n_blocks)
+        point = {
+            "k": len(level),
+            "block_h": self.block_h,
+            "block_w": self.block_w,
+            "distortion": self.block_mean(min_distances),
+            "mse": mse,
+            "psnr": 10 * math.log10(255 ** 2 / mse) if mse > 0 else float("inf"),
+            "bytes": size,
+            "bits_per_pixel": 8 * size / (self.orig_h * self.orig_w),
+        }
+        return point, labels
+
+    # uses a codebook saved by save_shared_codebook instead of training one on this image
+    # tree_path is the _tree.json saved when that codebook was trained in tree mode; blocks then walk the tree
+    def load_codebook(self, path, tree_path=None):
+        header, codebook, _ = parse_container(np.fromfile(path, dtype=np.uint8))
+        if (header["block_h"], header["block_w"]) != (self.block_h, self.block_w):
+            raise ValueError(
+                f"Shared codebook uses {header['block_h']}×{header['block_w']} blocks, not {self.block_h}×{self.block_w}."
+            )
+        self.codebook = codebook_matrix(codebook)
+        self.tree = None
+        self.use_tree = False
+        if tree_path is not None:
+            levels = self.read_tree(tree_path)
+            if len(levels[-1]) != len(self.codebook):
+                raise ValueError(f"Split tree ends with {len(levels[-1])} codevectors, the codebook has {len(self.codebook)}.")
+            # the last level is the codebook as stored, so labels index exactly what the decoder sees
+            self.tree = levels[:-1] + [self.codebook.copy()]
+            self.use_tree = True
+        return self.codebook
+
+    # uses a split tree saved by generate_codebook in tree mode (default: this image's _tree.json)
+    # its last level becomes the codebook, and compress() / compress_streaming() walk the tree
+    def load_tree(self, path=None):
+        self.tree = self.read_tree(self.tree_json if path is None else path)
+        self.codebook = self.tree[-1].copy()
+        self.use_tree = True
+        return self.codebook
+
+    # reads the levels of a _tree.json file as (K, dims) matrices
+    def read_tree(self, path):
+        with open(path) as f:
+            levels = [np.array(level, dtype=np.float64) for level in json.load(f)]
+        if not levels or any(level.shape[1:] != (self.block_h, self.block_w, self.channels) for level in levels):
+            raise ValueError(f"{os.path.basename(path)} is not a split tree of {self.block_h}×{self.block_w} blocks.")
+        return [level.reshape(len(level), -1) for level in levels]
+
+    # streaming encode against the current codebook: the image is read strip_rows block rows at a time
+    # and never held whole, which is the way to encode images too large for the block matrix
+    # in tree mode the blocks walk the split tree, giving the same labels as compress()
+    def compress_streaming(self, strip_rows=1, codebook_dtype="uint8"):
+        if self.codebook is None:
+            raise ValueError("No codebook yet.")
+        levels = self.tree if self.use_tree else None
+        distortion = stream_compress(self.path, self.codebook, self.block_h, self.block_w, self.container_path,
+                                     strip_rows, self.memory_budget, codebook_dtype, levels, self.allow_huge)
+        print(f"✓ Codebook and labels streamed to container: {self.container_path}")
+        return distortion
 
+
+    # decodes the old _codebook.json together with either _labels.bin or _labels.json
+    # only _labels.bin knows the original size; images decoded from _labels.json keep their padding
     def decompress(labels_path, codebook_path, output_path):
-        labels = np.array(json.load(open(labels_path)))
+        orig_h = orig_w = None
+        if labels_path.endswith(".bin"):
+            labels, orig_h, orig_w = read_labels_bin(labels_path)
+        else:
+            labels = np.array(json.load(open(labels_path)))
         codebook = np.array(json.load(open(codebook_path)))
 
-        n_rows, n_cols = labels.shape
-        block_h, block_w, channels = codebook.shape[1], codebook.shape[2], codebook.shape[3]
+        arr = blocks_to_image(labels, codebook, orig_h, orig_w)
+        Image.fromarray(arr, "RGB").save(output_path)
+        print(f"✓ Decompression done. Saved as {output_path}")
+        return arr
 
-        img_rows = []
-        for r in range(n_rows):
-            block_row = [codebook[labels[r][c]] for c in range(n_cols)]
-            for i in range(block_h):
-                row = []
-                for blk in block_row:
-                    row.extend(blk[i])
-                img_rows.append(row)
+    # decodes a .vqc container written by compress
+    # shared_codebook is the codebook loaded once with load_shared_codebook for containers that leave it out
+    def decompress_container(container_path, output_path, shared_codebook=None):
+        header, codebook, labels = read_container(container_path, shared_codebook)
 
-        arr = np.array(img_rows, dtype=np.uint8).reshape(n_rows*block_h, n_cols*block_w, channels)
+        arr = blocks_to_image(labels, codebook, header["orig_h"], header["orig_w"])
         Image.fromarray(arr, "RGB").save(output_path)
         print(f"✓ Decompression done. Saved as {output_path}")
         return arr
 
+# rebuilds the image from a grid of labels and a (K, block_h, block_w, channels) codebook
+# out_h / out_w crop the padding away; only the last block row and column are ever built past the original size
+def blocks_to_image(labels, codebook, out_h=None, out_w=None):
+    n_rows, n_cols = labels.shape
+    block_h, block_w, channels = codebook.shape[1], codebook.shape[2], codebook.shape[3]
+    out_h = n_rows * block_h if out_h is None else out_h
+    out_w = n_cols * block_w if out_w is None else out_w
+    codebook = np.asarray(codebook).astype(np.uint8)
+
+    # gathers one codevector per label, then puts each block row's pixel rows side by side
+    def assemble(grid):
+        tiles = codebook[grid] # (rows, cols, block_h, block_w, channels)
+        return tiles.swapaxes(1, 2).reshape(grid.shape[0]*block_h, grid.shape[1]*block_w, channels)
+
+    arr = np.empty((out_h, out_w, channels), dtype=np.uint8)
+    full_rows, full_cols = out_h // block_h, out_w // block_w
+    arr[:full_rows*block_h, :full_cols*block_w] = assemble(labels[:full_rows, :full_cols])
+    if full_cols < n_cols and out_w > full_cols*block_w: # partial last block column
+        arr[:full_rows*block_h, full_cols*block_w:] = assemble(labels[:full_rows, full_cols:full_cols+1])[:, :out_w - full_cols*block_w]
+    if full_rows < n_rows and out_h > full_rows*block_h: # partial last block row, including the corner
+        arr[full_rows*block_h:] = assemble(labels[full_rows:full_rows+1])[:out_h - full_rows*block_h, :out_w]
+    return arr
+
+# writes the header, the codebook as raw uint8 or float16 values and the bit-packed labels into one file
+# label_coding "huffman" replaces the fixed-width labels with a static canonical Huffman code built from the label counts
+# when that would be smaller; the header records which coding was used
+def write_container(path, orig_h, orig_w, block_h, block_w, codebook, labels, codebook_dtype="uint8",
+                    label_coding="fixed"):
+    if codebook_dtype not in CONTAINER_DTYPES:
+        raise ValueError(f"Invalid container codebook dtype '{codebook_dtype}'. Allowed: {', '.join(CONTAINER_DTYPES)}")
+    if label_coding not in LABEL_CODINGS:
+        raise ValueError(f"Invalid label coding '{label_coding}'. Allowed: {', '.join(LABEL_CODINGS)}")
+    k = len(codebook)
+    labels = np.asarray(labels).reshape(-1)
+
+    if label_coding == "huffman":
+        # the table of code lengths costs k bytes, so small images, large k or k=1 (0 bits per fixed label)
+        # can come out bigger than fixed-width labels; those files fall back to fixed-width coding
+        bits_needed = math.ceil(math.log2(k))
+        counts = np.bincount(labels, minlength=k)
+        lengths = huffman_code_lengths(counts, max(HUFFMAN_MAX_BITS, bits_needed))
+        huffman_bytes = k + -(-int(counts @ lengths) // 8)
+        if huffman_bytes >= -(-len(labels) * bits_needed // 8):
+            label_coding = "fixed"
+
+    with open(path, "wb") as f:
+        bits_needed = write_container_head(f, orig_h, orig_w, block_h, block_w, codebook, codebook_dtype, label_coding)
+        if label_coding == "huffman":
+            f.write(lengths.astype(np.uint8).tobytes())
+            f.write(huffman_encode(labels, lengths))
+        else:
+            f.write(pack_labels(labels, bits_needed))
+
+# writes the container header and the raw codebook, returns the fixed label width in bits
+def write_container_head(f, orig_h, orig_w, block_h, block_w, codebook, codebook_dtype, label_coding):
+    k, dims = codebook.shape
+    channels = dims // (block_h * block_w)
+    bits_needed = math.ceil(math.log2(k))
+
+    if codebook_dtype == "uint8":
+        raw = np.clip(np.rint(codebook), 0, 255).astype(np.uint8)
+    elif codebook_dtype == "shared": # the decoder brings the codebook, only a checksum is kept to catch mix-ups
+        raw = np.array([codebook_checksum(codebook)], dtype="<u4")
+    else:
+        raw = codebook.astype("<f2")
+
+    f.write(CONTAINER_HEADER.pack(CONTAINER_MAGIC, orig_h, orig_w, block_h, block_w, channels,
+                                  k, bits_needed, CONTAINER_DTYPES[codebook_dtype], LABEL_CODINGS[label_coding]))
+    f.write(raw.tobytes())
+    return bits_needed
+
+# reads a container back into (header dict, uint8 codebook of shape (K, block_h, block_w, channels), labels grid)
+def read_container(path, shared_codebook=None):
+    with open(path, "rb") as f:
+        data = f.read()
+    header, codebook, offset = parse_container(data, shared_codebook)
+    n_rows, n_cols, k = header["n_rows"], header["n_cols"], header["k"]
+
+    if header["label_coding"] == "huffman":
+        lengths = np.frombuffer(data, dtype=np.uint8, count=k, offset=offset)
+        labels = huffman_decode(data[offset + k:], lengths, n_rows * n_cols)
+    else:
+        labels = unpack_labels(data[offset:], header["bits"], n_rows * n_cols)
+    return header, codebook, labels.reshape(n_rows, n_cols)
+
+# parses the header and codebook of a container held in any buffer (bytes or a memory map)
+# returns (header dict, uint8 codebook, offset of the label section)
+# containers written against a shared codebook need that codebook passed in
+def parse_container(data, shared_codebook=None):
+    if len(data) < CONTAINER_HEADER.size:
+        raise ValueError("Invalid container: header too short.")
+
+    (magic, orig_h, orig_w, block_h, block_w, channels,
+     k, bits_needed, dtype_code, coding_code) = CONTAINER_HEADER.unpack_from(data)
+    if magic != CONTAINER_MAGIC:
+        raise ValueError("Invalid container: bad magic number.")
+    header = {
+        "orig_h": orig_h, "orig_w": orig_w, "block_h": block_h, "block_w": block_w,
+        "channels": channels, "k": k, "bits": bits_needed,
+        "codebook_dtype": {code: name for name, code in CONTAINER_DTYPES.items()}[dtype_code],
+        "label_coding": {code: name for name, code in LABEL_CODINGS.items()}[coding_code],
+        "n_rows": -(-orig_h // block_h),
+        "n_cols": -(-orig_w // block_w),
+    }
+
+    offset = CONTAINER_HEADER.size
+    if header["codebook_dtype"] == "shared":
+        if shared_codebook is None:
+            raise ValueError("Container was encoded against a shared codebook; pass it in to decode.")
+        checksum = int(np.frombuffer(data, dtype="<u4", count=1, offset=offset)[0])
+        if len(shared_codebook) != k or codebook_checksum(shared_codebook) != checksum:
+            raise ValueError("Shared codebook does not match the one this container was encoded with.")
+        codebook = np.clip(np.rint(np.asarray(shared_codebook, dtype=np.float64)), 0, 255).astype(np.uint8)
+        return header, codebook.reshape(k, block_h, block_w, channels), offset + 4
+
+    dtype = np.uint8 if header["codebook_dtype"] == "uint8" else np.dtype("<f2")
+    count = k * block_h * block_w * channels
+    codebook = np.frombuffer(data, dtype=dtype, count=count, offset=offset)
+    offset += codebook.nbytes
+    if dtype != np.uint8:
+        codebook = np.clip(np.rint(codebook.astype(np.float32)), 0, 255).astype(np.uint8)
+    codebook = codebook.reshape(k, block_h, block_w, channels)
+    return header, codebook, offset
+
+# size in bytes of a fixed-width container with a uint8 codebook
+def container_size(k, block_h, block_w, n_blocks, channels=3):
+    bits_needed = math.ceil(math.log2(k))
+    return CONTAINER_HEADER.size + k * block_h * block_w * channels + -(-n_blocks * bits_needed // 8)
+
+# rate control: picks the smallest codebook (and, among block_sizes, the block size) that reaches target_psnr
+# or target_mse, or the best quality that fits in max_bytes
+# every candidate k comes from the split levels of one LBG run per block size; quality targets stop splitting
+# as soon as they are met, and a byte budget caps k before training starts
+# returns the chosen Codebook and its rate-distortion point; only the chosen codebook's files are written
+def select_codebook(path, target_psnr=None, target_mse=None, max_bytes=None, block_sizes=((2, 2),), max_k=1024,
+                    codebook_options=None, **lbg_options):
+    if [target_psnr, target_mse, max_bytes].count(None) != 2:
+        raise ValueError("Give exactly one of target_psnr, target_mse or max_bytes.")
+    codebook_options = codebook_options or {}
+
+    def meets(point):
+        if target_psnr is not None:
+            return point["psnr"] >= target_psnr
+        if target_mse is not None:
+            return point["mse"] <= target_mse
+        return point["bytes"] <= max_bytes
+
+    candidates = []
+    for block_h, block_w in block_sizes:
+        cb = Codebook(path, block_h, block_w, **codebook_options)
+        k = min(max_k, cb.n_blocks)
+        if max_bytes is not None:
+            # the size of every level is known up front, so only levels that fit are trained
+            if container_size(1, block_h, block_w, cb.n_blocks) > max_bytes:
+                continue
+            while k > 1 and container_size(1 << math.ceil(math.log2(k)), block_h, block_w, cb.n_blocks) > max_bytes:
+                k //= 2
+            cb.generate_codebook(k, save=False, **lbg_options)
+        else:
+            cb.generate_codebook(k, stop_when=lambda c: meets(c.level_point(len(c.tree) - 1)[0]), save=False,
+                                 **lbg_options)
+        candidates.append((cb, cb.level_point(len(cb.tree) - 1)[0]))
+
+    if not candidates:
+        raise ValueError(f"No codebook fits in {max_bytes} bytes, even with k=1.")
+    reached = [c for c in candidates if meets(c[1])]
+    if not reached:
+        print("Target not reached with any block size; returning the best quality found.")
+        chosen = max(candidates, key=lambda c: c[1]["psnr"])
+    elif max_bytes is not None:
+        chosen = max(reached, key=lambda c: c[1]["psnr"])
+    else:
+        chosen = min(reached, key=lambda c: c[1]["bytes"])
+    chosen[0].save_codebook() # candidates of every block size share the output names, so only the chosen one is written
+    return chosen
+
+# CRC-32 of a codebook as the decoder sees it (rounded to uint8)
+def codebook_checksum(codebook):
+    raw = np.clip(np.rint(np.asarray(codebook, dtype=np.float64)), 0, 255).astype(np.uint8)
+    return zlib.crc32(raw.tobytes())
+
+# trains one codebook on blocks sampled from every image in paths, for encoding a whole corpus against it
+# samples_per_image blocks are drawn from each image so one large image cannot dominate the codebook
+# with tree=True the split tree is also saved as <name>_tree.json, to be given to load_codebook with the codebook
+def train_shared_codebook(paths, block_h, block_w, k, name="shared", samples_per_image=20000, seed=None,
+                          tree=False, **lbg_options):
+    rng = np.random.default_rng(seed)
+    samples = []
+    for path in paths:
+        blocks = Codebook(path, block_h, block_w).blocks
+        if len(blocks) > samples_per_image:
+            blocks = blocks[rng.choice(len(blocks), samples_per_image, replace=False)]
+        samples.append(blocks)
+    print(f"Sampled {sum(len(b) for b in samples)} blocks from {len(samples)} images")
+
+    cb = Codebook(os.path.join(script_dir, name), block_h, block_w, tree=tree, blocks=np.concatenate(samples))
+    cb.generate_codebook(k, seed=seed, **lbg_options)
+    return cb.codebook
+
+# saves a shared codebook as a container without labels, so it is read back with the same parser
+def save_shared_codebook(path, codebook, block_h, block_w, codebook_dtype="uint8"):
+    codebook = codebook_matrix(codebook)
+    with open(path, "wb") as f:
+        write_container_head(f, 0, 0, block_h, block_w, codebook, codebook_dtype, "fixed")
+    print(f"✓ Shared codebook saved: {path}")
+
+# loads a shared codebook once; pass the result to decompress_container / ContainerReader for every image
+def load_shared_codebook(path):
+    _, codebook, _ = parse_container(np.fromfile(path, dtype=np.uint8))
+    return codebook
+
+# random-access decoding of fixed-width containers
+# the file is memory-mapped and a region only reads the bytes of the label rows that cover it,
+# so the cost of a viewport does not depend on the size of the whole image
+class ContainerReader:
+    def __init__(self, path, shared_codebook=None):
+        self.path = path
+        self.data = np.memmap(path, dtype=np.uint8, mode="r")
+        self.header, self.codebook, self.labels_offset = parse_container(self.data, shared_codebook)
+        if self.header["label_coding"] != "fixed":
+            raise ValueError("Random access needs fixed-width labels; Huffman coded containers must be decoded whole.")
+        self.height = self.header["orig_h"]
+        self.width = self.header["orig_w"]
+
+    # labels of block rows r0:r1 and block columns c0:c1
+    def labels(self, r0, r1, c0, c1):
+        bits_needed = self.header["bits"]
+        n_cols = self.header["n_cols"]
+        if bits_needed == 0:
+            return np.zeros((r1 - r0, c1 - c0), dtype=np.int64)
+
+        # bit position of the first wanted label in every row, and the bytes that span the row segment
+        start_bits = (np.arange(r0, r1, dtype=np.int64) * n_cols + c0) * bits_needed
+        n_bits = (c1 - c0) * bits_needed
+        n_bytes = (start_bits[0] % 8 + n_bits + 7) // 8 + 1
+        byte_index = self.labels_offset + start_bits[:, None] // 8 + np.arange(n_bytes)
+        byte_index = np.minimum(byte_index, len(self.data) - 1) # the last row may end right at the file end
+        bits = np.unpackbits(self.data[byte_index], axis=1)
+
+        # drops the leading bits that belong to the previous label in each row
+        columns = (start_bits % 8)[:, None] + np.arange(n_bits)
+        bits = np.take_along_axis(bits, columns, axis=1).reshape(r1 - r0, c1 - c0, bits_needed)
+        weights = 1 << np.arange(bits_needed - 1, -1, -1, dtype=np.int64) # most significant bit first
+        return bits @ weights
+
+    # decodes the pixel rectangle [top, top + height) x [left, left + width) of the original image
+    def region(self, top, left, height, width):
+        if top < 0 or left < 0 or height <= 0 or width <= 0 or top + height > self.height or left + width > self.width:
+            raise ValueError(f"Region {height}×{width} at ({top}, {left}) is outside the {self.height}×{self.width} image.")
+        block_h, block_w = self.header["block_h"], self.header["block_w"]
+        r0, r1 = top // block_h, -(-(top + height) // block_h)
+        c0, c1 = left // block_w, -(-(left + width) // block_w)
+
+        arr = blocks_to_image(self.labels(r0, r1, c0, c1), self.codebook)
+        y, x = top - r0 * block_h, left - c0 * block_w
+        return np.ascontiguousarray(arr[y:y + height, x:x + width])
+
+# Huffman code length of every label from its count (0 for labels that never occur)
+# counts are halved until the longest code fits in max_bits
+def huffman_code_lengths(counts, max_bits):
+    counts = np.asarray(counts, dtype=np.int64)
+    while True:
+        lengths = np.zeros(len(counts), dtype=np.int64)
+        used = np.flatnonzero(counts)
+        if len(used) == 1:
+            lengths[used] = 1
+            return lengths
+        heap = [(int(counts[sym]), int(sym), [int(sym)]) for sym in used]
+        heapq.heapify(heap)
+        while len(heap) > 1:
+            count_a, tie_a, group_a = heapq.heappop(heap)
+            count_b, tie_b, group_b = heapq.heappop(heap)
+            lengths[group_a] += 1
+            lengths[group_b] += 1
+            heapq.heappush(heap, (count_a + count_b, min(tie_a, tie_b), group_a + group_b))
+        if lengths.max() <= max_bits:
+            return lengths
+        counts = np.where(counts > 0, (counts + 1) // 2, 0)
+
+# canonical Huffman codes: shorter codes first, ties broken by label, each code one more than the previous
+def canonical_codes(lengths):
+    codes = np.zeros(len(lengths), dtype=np.int64)
+    code = 0
+    prev_len = 0
+    for sym in sorted(np.flatnonzero(lengths), key=lambda s: (lengths[s], s)):
+        code <<= int(lengths[sym]) - prev_len
+        codes[sym] = code
+        code += 1
+        prev_len = int(lengths[sym])
+    return codes
+
+# writes every label's canonical code, most significant bit first, into one byte buffer
+def huffman_encode(labels, lengths, chunk=1 << 20):
+    codes = canonical_codes(lengths)
+    parts = []
+    for start in range(0, len(labels), chunk):
+        tile = labels[start:start + chunk]
+        big_endian = codes[tile].astype(">u4").view(np.uint8).reshape(-1, 4)
+        bits = np.unpackbits(big_endian, axis=1)
+        keep = np.arange(32) >= (32 - lengths[tile])[:, None] # the low lengths[label] bits of each code
+        parts.append(bits[keep])
+    return np.packbits(np.concatenate(parts) if parts else np.zeros(0, dtype=np.uint8)).tobytes()
+
+# decodes count labels with a lookup table indexed by the next max_len bits of the stream
+# the table gives every bit position its label and code length; only the walk from code to code is a Python loop
+def huffman_decode(data, lengths, count, chunk=1 << 20):
+    lengths = np.asarray(lengths, dtype=np.int64)
+    if count == 0:
+        return np.zeros(0, dtype=np.int64)
+    max_len = int(lengths.max())
+    codes = canonical_codes(lengths)
+    table_label = np.zeros(1 << max_len, dtype=np.int64)
+    table_length = np.zeros(1 << max_len, dtype=np.uint8)
+    for sym in np.flatnonzero(lengths):
+        shift = max_len - int(lengths[sym])
+        first = int(codes[sym]) << shift
+        table_label[first:first + (1 << shift)] = sym
+        table_length[first:first + (1 << shift)] = lengths[sym]
+
+    # the stream is decoded chunk bit positions at a time, so the peek table stays a few MiB for any image
+    peek_dtype = np.uint16 if max_len <= 16 else np.uint32
+    raw = np.frombuffer(data, dtype=np.uint8)
+    total_bits = 8 * len(raw)
+    chunk -= chunk % 8
+    labels = np.empty(count, dtype=np.int64)
+    done = 0
+    pos = 0
+    for start in range(0, total_bits, chunk):
+        stop = min(start + chunk, total_bits)
+        if done == count:
+            break
+        if pos >= stop:
+            continue
+        n_positions = stop - start
+        # bits from start to stop plus max_len bits of look-ahead, zero past the end of the stream
+        window = np.zeros(n_positions + max_len, dtype=np.uint8)
+        chunk_bits = np.unpackbits(raw[start // 8:-(-(stop + max_len) // 8)])[:len(window)]
+        window[:len(chunk_bits)] = chunk_bits
+        peek = np.zeros(n_positions, dtype=peek_dtype) # the next max_len bits starting at every position
+        for j in range(max_len):
+            peek <<= 1
+            peek |= window[j:j + n_positions]
+        steps = table_length[peek].tobytes()
+
+        offsets = []
+        append = offsets.append
+        p = pos - start
+        while p < n_positions:
+            step = steps[p]
+            if not step:
+                raise ValueError("Invalid container: corrupt Huffman label data.")
+            append(p)
+            p += step
+        offsets = offsets[:count - done] # the zero bits padding the last byte may decode as extra labels
+        labels[done:done + len(offsets)] = table_label[peek[offsets]]
+        done += len(offsets)
+        pos = start + p
+
+    if done < count:
+        raise ValueError("Invalid container: Huffman label data too short.")
+    return labels
+
+# packs every label into bits_needed bits, most significant bit first, in one byte buffer
+# the last byte is padded with zero bits on the right
+def pack_labels(labels, bits_needed, chunk=1 << 20):
+    labels = np.asarray(labels).reshape(-1)
+    if bits_needed == 0 or len(labels) == 0:
+        return b""
+    # chunks hold a multiple of 8 labels so every chunk ends on a byte boundary
+    chunk -= chunk % 8
+    parts = []
+    for start in range(0, len(labels), chunk):
+        parts.append(np.packbits(label_bits(labels[start:start + chunk], bits_needed)).tobytes())
+    return b"".join(parts)
+
+# the bits_needed low bits of every label, most significant first, as one flat array of 0/1 values
+def label_bits(labels, bits_needed):
+    big_endian = np.asarray(labels).astype(">u4").view(np.uint8).reshape(-1, 4)
+    return np.unpackbits(big_endian, axis=1)[:, 32 - bits_needed:].reshape(-1)
+
+# header fields (rows, columns, original height, original width, bits) of a _labels.bin file, or None when the
+# data has no header or its payload doesn't match it, as with the headerless files of older versions
+def labels_bin_header(data):
+    if len(data) < LABELS_BIN_HEADER.size:
+        return None
+    magic, n_rows, n_cols, orig_h, orig_w, bits_needed = LABELS_BIN_HEADER.unpack_from(data)
+    if magic != LABELS_BIN_MAGIC or len(data) - LABELS_BIN_HEADER.size != -(-n_rows * n_cols * bits_needed // 8):
+        return None
+    return n_rows, n_cols, orig_h, orig_w, bits_needed
+
+# True when path is a _labels.bin file with a header that read_labels_bin can decode
+def is_labels_bin(path):
+    if not os.path.exists(path):
+        return False
+    with open(path, "rb") as f:
+        data = f.read()
+    return labels_bin_header(data) is not None
+
+# reads a _labels.bin file back into (label grid, original height, original width)
+def read_labels_bin(path):
+    with open(path, "rb") as f:
+        data = f.read()
+    header = labels_bin_header(data)
+    if header is None:
+        raise ValueError("Invalid labels .bin file: no header or size doesn't match it. "
+                         "Files written by older versions are decoded from _labels.json.")
+    n_rows, n_cols, orig_h, orig_w, bits_needed = header
+    labels = unpack_labels(data[LABELS_BIN_HEADER.size:], bits_needed, n_rows * n_cols)
+    return labels.reshape(n_rows, n_cols), orig_h, orig_w
+
+# inverse of pack_labels: reads count labels of bits_needed bits each from a byte buffer
+def unpack_labels(data, bits_needed, count, chunk=1 << 20):
+    labels = np.zeros(count, dtype=np.int64)
+    if bits_needed == 0 or count == 0:
+        return labels
+    chunk -= chunk % 8
+    raw = np.frombuffer(data, dtype=np.uint8)
+    weights = 1 << np.arange(bits_needed - 1, -1, -1, dtype=np.int64) # most significant bit first
+    for start in range(0, count, chunk):
+        n = min(chunk, count - start)
+        first_byte = start * bits_needed // 8
+        bits = np.unpackbits(raw[first_byte:first_byte + -(-n * bits_needed // 8)])[:n * bits_needed]
+        labels[start:start + n] = bits.reshape(n, bits_needed) @ weights
+    return labels
+
+# encodes an image strip by strip against a fixed codebook and appends the packed labels to a container as it goes
+# only strip_rows block rows of pixels, their blocks and one tile of distances are in memory at a time
+# the output is the same container compress() writes with fixed-width labels; returns the mean distortion
+# levels, when given, is a split tree ending with codebook: blocks are then encoded by walking it (see tree_search)
+# allow_huge lifts PIL's decompression-bomb limit (about 179 MP) for gigapixel scans
+def stream_compress(path, codebook, block_h, block_w, output_path, strip_rows=1,
+                    memory_budget=DEFAULT_MEMORY_BUDGET, codebook_dtype="uint8", levels=None, allow_huge=False):
+    if codebook_dtype not in CONTAINER_DTYPES:
+        raise ValueError(f"Invalid container codebook dtype '{codebook_dtype}'. Allowed: {', '.join(CONTAINER_DTYPES)}")
+    codebook = codebook_matrix(codebook)
+    if levels is not None:
+        levels = [codebook_matrix(level) for level in levels]
+        if len(levels[-1]) != len(codebook):
+            raise ValueError("The last level of the split tree must be the codebook.")
+    orig_h, orig_w = probe_image(path, allow_huge)
+    pad_w = (block_w - (orig_w % block_w)) % block_w
+    n_cols = (orig_w + pad_w) // block_w
+    n_blocks = 0
+    total_distortion = 0.0
+
+    with open(output_path, "wb") as f:
+        bits_needed = write_container_head(f, orig_h, orig_w, block_h, block_w, codebook, codebook_dtype, "fixed")
+        carry = np.zeros(0, dtype=np.uint8) # bits of the last strip that did not fill a whole byte
+        for strip in image_strips(path, strip_rows * block_h, allow_huge):
+            # pads with edge pixels exactly like Codebook does; only the last strip can be short
+            pad_h = (block_h - (len(strip) % block_h)) % block_h
+            strip = np.pad(strip, ((0, pad_h), (0, pad_w), (0, 0)), mode="edge")
+            rows = len(strip) // block_h
+            blocks = strip.reshape(rows, block_h, n_cols, block_w, 3).swapaxes(1, 2).reshape(rows * n_cols, -1)
+
+            if levels is not None:
+                labels, min_distances = tree_search(blocks, levels, memory_budget)
+            else:
+                labels, min_distances = nearest_codevectors(blocks, codebook, memory_budget)
+            n_blocks += len(labels)
+            total_distortion += float(min_distances.sum())
+
+            bits = np.concatenate([carry, label_bits(labels, bits_needed)])
+            whole = len(bits) - len(bits) % 8
+            f.write(np.packbits(bits[:whole]).tobytes())
+            carry = bits[whole:]
+        if len(carry) > 0:
+            f.write(np.packbits(carry).tobytes())
+
+    return total_distortion / n_blocks
+
+# turns a codebook of shape (K, block_h, block_w, channels) or (K, dims) into a float64 (K, dims) matrix
+def codebook_matrix(codebook):
+    codebook = np.asarray(codebook, dtype=np.float64)
+    return codebook.reshape(len(codebook), -1)
+
+# raw pixel layouts that can be read straight from the file: bytes per pixel and where R, G, B sit
+RAW_RGB_LAYOUTS = {
+    "RGB": (3, [0, 1, 2]), "BGR": (3, [2, 1, 0]),
+    "RGBX": (4, [0, 1, 2]), "RGBA": (4, [0, 1, 2]),
+    "BGRX": (4, [2, 1, 0]), "BGRA": (4, [2, 1, 0]),
+}
+
+# yields the image as consecutive RGB strips of strip_h rows (the last one may be shorter)
+# uncompressed BMP/TIFF files are memory-mapped so only the rows of the current strip are read;
+# compressed formats (PNG, JPEG, compressed TIFF) can only be decoded whole, so they are refused
+# rather than breaking the one-strip memory bound
+def image_strips(path, strip_h, allow_huge=False):
+    with open_image(path, allow_huge) as img:
+        w, h = img.size
+        image_format = img.format
+        row_offsets = raw_row_offsets(img)
+
+    if row_offsets is None:
+        raise ValueError(
+            f"{os.path.basename(path)} ({image_format}) can't be streamed: only uncompressed RGB BMP/TIFF files "
+            "are read strip by strip. Use compress() instead, or convert the image to an uncompressed TIFF."
+        )
+
+    offsets, bytes_per_pixel, rgb = row_offsets
+    data = np.memmap(path, dtype=np.uint8, mode="r")
+    columns = np.arange(w * bytes_per_pixel)
+    for y in range(0, h, strip_h):
+        rows = data[offsets[y:y + strip_h, None] + columns]
+        yield rows.reshape(len(rows), w, bytes_per_pixel)[:, :, rgb]
+
+# file offset of every pixel row when all of the image is stored as raw full-width tiles, else None
+def raw_row_offsets(img):
+    if img.mode not in ("RGB", "RGBA", "RGBX"):
+        return None
+    w, h = img.size
+    offsets = np.full(h, -1, dtype=np.int64)
+    layout = None
+    for tile in img.tile:
+        codec, (x0, y0, x1, y1), offset, args = tile[0], tile[1], tile[2], tile[3]
+        rawmode, stride, orientation = (args, 0, 1) if isinstance(args, str) else (tuple(args) + (0, 1))[:3]
+        if codec != "raw" or x0 != 0 or x1 != w or rawmode not in RAW_RGB_LAYOUTS:
+            return None
+        if layout is not None and layout != RAW_RGB_LAYOUTS[rawmode]:
+            return None
+        layout = RAW_RGB_LAYOUTS[rawmode]
+        stride = stride or w * layout[0]
+        rows = np.arange(y1 - y0)
+        if orientation < 0: # stored bottom-up, like most BMP files
+            rows = rows[::-1]
+        offsets[y0:y1] = offset + rows * stride
+    if layout is None or (offsets < 0).any():
+        return None
+    return offsets, layout[0], layout[1]
+
+# opens an image lazily; allow_huge lifts PIL's decompression-bomb limit for this open only
+def open_image(path, allow_huge=False):
+    if not allow_huge:
+        return Image.open(path)
+    limit = Image.MAX_IMAGE_PIXELS
+    Image.MAX_IMAGE_PIXELS = None
+    try:
+        return Image.open(path)
+    finally:
+        Image.MAX_IMAGE_PIXELS = limit
+
+# reads only the image header and returns its (height, width)
+def probe_image(path, allow_huge=False):
+    with open_image(path, allow_huge) as img:
+        w, h = img.size
+    return h, w
+
 def validate_image_path(path, allowed_exts=None):
     if allowed_exts is None:
         allowed_exts = [".png", ".jpg", ".jpeg", ".bmp", ".tiff"]
@@ -187,6 +1201,126 @@ def validate_image_path(path, allowed_exts=None):
 
     return path
 
+# image files of a directory, or of a glob pattern such as "scans/*.png"
+def find_images(source):
+    pattern = os.path.join(source, "*") if os.path.isdir(source) else source
+    images = []
+    for path in sorted(glob.glob(pattern)):
+        try:
+            images.append(validate_image_path(os.path.abspath(path)))
+        except (FileNotFoundError, ValueError):
+            continue
+    return images
+
+# limits the address space of a batch worker process (Unix only)
+def limit_worker_memory(max_bytes):
+    import resource
+    resource.setrlimit(resource.RLIMIT_AS, (max_bytes, max_bytes))
+
+# trains and encodes one image inside a batch worker and reports how it went
+def compress_one(path, block_h, block_w, k, codebook_options, lbg_options, compress_options):
+    start = time.perf_counter()
+    try:
+        cb = Codebook(path, block_h, block_w, **codebook_options)
+        cb.generate_codebook(k, **lbg_options)
+        cb.compress(**compress_options)
+        return {
+            "path": path, "seconds": time.perf_counter() - start, "distortion": cb.distortion,
+            "bytes": os.path.getsize(cb.container_path), "error": None,
+        }
+    except Exception as e: # any bad file (decompression bomb, truncated data, ...) only fails its own image
+        return failed_result(path, f"{type(e).__name__}: {e}", time.perf_counter() - start)
+
+def failed_result(path, error, seconds=0.0):
+    return {"path": path, "seconds": seconds, "distortion": None, "bytes": None, "error": error}
+
+# result of a batch future, or None when its worker process died and broke the pool
+def future_result(future, path):
+    try:
+        return future.result()
+    except BrokenProcessPool:
+        return None
+    except Exception as e:
+        return failed_result(path, f"{type(e).__name__}: {e}")
+
+# compresses every image of a directory or glob on a pool of worker processes
+# results are yielded as soon as each image finishes; a worker's memory can be capped with max_worker_memory (bytes)
+def batch_compress(source, block_h, block_w, k, workers=None, max_worker_memory=None,
+                   codebook_options=None, lbg_options=None, compress_options=None):
+    paths = find_images(source)
+    if not paths:
+        raise FileNotFoundError(f"No images found for: {source}")
+    codebook_options = codebook_options or {}
+    lbg_options = lbg_options or {}
+    compress_options = compress_options or {}
+
+    args = (block_h, block_w, k, codebook_options, lbg_options, compress_options)
+
+    # outputs are named after the image, so a.png and a.jpg would overwrite each other's files
+    pending = deque()
+    seen = {}
+    for path in paths:
+        name = os.path.splitext(os.path.basename(path))[0]
+        if name in seen:
+            yield failed_result(path, f"same output name as {os.path.basename(seen[name])}, skipped")
+        else:
+            seen[name] = path
+            pending.append(path)
+
+    initializer, initargs = (limit_worker_memory, (max_worker_memory,)) if max_worker_memory else (None, ())
+    workers = workers or os.cpu_count() or 1
+    # only as many images as workers are handed to the pool at a time, so when a worker dies (e.g. killed under
+    # the memory cap) and breaks the pool, the images in flight are the ones that were running
+    # those are retried afterwards in a fresh worker each, so only the one that kills its worker fails;
+    # the images not started yet go on in a new pool of the same size
+    retries = []
+    while pending:
+        with ProcessPoolExecutor(max_workers=workers, initializer=initializer, initargs=initargs) as pool:
+            running = {}
+            broken = False
+            while running or (pending and not broken):
+                while pending and not broken and len(running) < workers:
+                    path = pending.popleft()
+                    try:
+                        running[pool.submit(compress_one, path, *args)] = path
+                    except BrokenProcessPool:
+                        pending.appendleft(path)
+                        broken = True
+                if not running:
+                    break
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    path = running.pop(future)
+                    result = future_result(future, path)
+                    if result is None:
+                        broken = True
+                        retries.append(path)
+                    else:
+                        yield result
+
+    for path in retries:
+        with ProcessPoolExecutor(max_workers=1, initializer=initializer, initargs=initargs) as pool:
+            result = future_result(pool.submit(compress_one, path, *args), path)
+        yield result or failed_result(path, "worker process died (out of memory?)")
+
+# prints the per-file timing and distortion of a batch run
+# seconds are per-image worker wall-clock times; elapsed is the wall-clock time of the whole batch
+def print_batch_summary(results, elapsed=None):
+    print(f"\n{'File':<40}{'Seconds':>10}{'Distortion':>12}{'Bytes':>12}")
+    print("-"*74)
+    for r in results:
+        name = os.path.basename(r["path"])
+        if r["error"] is not None:
+            print(f"{name:<40}{r['seconds']:>10.2f}  failed: {r['error']}")
+        else:
+            print(f"{name:<40}{r['seconds']:>10.2f}{r['distortion']:>12.3f}{r['bytes']:>12}")
+    done = [r for r in results if r["error"] is None]
+    worker_seconds = sum(r['seconds'] for r in results)
+    if elapsed is None:
+        print(f"{len(done)}/{len(results)} images compressed, {worker_seconds:.2f}s of worker time")
+    else:
+        print(f"{len(done)}/{len(results)} images compressed in {elapsed:.2f}s ({worker_seconds:.2f}s of worker time)")
+
 
 if __name__ == "__main__":
     print("=+= Vector Quantization System =+=")
@@ -195,9 +1329,10 @@ if __name__ == "__main__":
         print("\nWhat would you like to do?:")
         print("1) Compress Image")
         print("2) Decompress Image")
-        print("3) Exit")
+        print("3) Compress a folder of images")
+        print("4) Exit")
 
-        choice = input("Please choose from(1/2/3): ")
+        choice = input("Please choose from(1/2/3/4): ")
 
         if choice == "1":
             path = input("Enter image path: ")
@@ -214,9 +1349,8 @@ if __name__ == "__main__":
                 if bh <= 0 or bw <= 0:
                     raise ValueError("Block height and width must be positive integers.")
 
-                # Load image first to validate against its size
-                cb_temp = Codebook(path, 1, 1)  # temporary object just to get image shape
-                img_h, img_w = cb_temp.orig_h, cb_temp.orig_w
+                # Read the image header first to validate against its size
+                img_h, img_w = probe_image(path)
 
                 if bh > img_h or bw > img_w:
                     raise ValueError(
@@ -243,13 +1377,44 @@ if __name__ == "__main__":
                     print("Error:", e)
                     continue
             base_name = os.path.splitext(os.path.basename(path))[0]
+            container_path = os.path.join(script_dir, f"{base_name}.vqc")
+            labels_bin_path = os.path.join(script_dir, f"{base_name}_labels.bin")
             labels_path = os.path.join(script_dir, f"{base_name}_labels.json")
             codebook_path = os.path.join(script_dir, f"{base_name}_codebook.json")
             reconstructed_path = os.path.join(script_dir, f"{base_name}_reconstructed.png")
 
-            Codebook.decompress(labels_path, codebook_path, reconstructed_path)
+            try:
+                if os.path.exists(container_path):
+                    Codebook.decompress_container(container_path, reconstructed_path)
+                elif is_labels_bin(labels_bin_path): # legacy outputs, the packed labels are much faster to read
+                    Codebook.decompress(labels_bin_path, codebook_path, reconstructed_path)
+                else: # files written by older versions, whose _labels.bin has no header
+                    Codebook.decompress(labels_path, codebook_path, reconstructed_path)
+            except Exception as e:
+                print("Error:", e)
+                continue
 
         elif choice == "3":
+            source = input("Enter folder or glob pattern: ")
+            try:
+                bh = int(input("Block height: "))
+                bw = int(input("Block width: "))
+                k = int(input("Levels of desired Quantization (size of codebook): "))
+                if bh <= 0 or bw <= 0 or k <= 0:
+                    raise ValueError("Block size and codebook size must be positive integers.")
+
+                results = []
+                start = time.perf_counter()
+                for result in batch_compress(source, bh, bw, k):
+                    status = "failed" if result["error"] else f"{result['seconds']:.2f}s"
+                    print(f"✓ {os.path.basename(result['path'])}: {status}")
+                    results.append(result)
+                print_batch_summary(results, time.perf_counter() - start)
+            except (ValueError, FileNotFoundError) as e:
+                print("Invalid input:", e)
+                continue
+
+        elif choice == "4":
             print("Exiting...")
             break
 